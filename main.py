@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 import os
 import re
+import json
+import html
+import calendar
+import hashlib
+import time as _time
 import requests
-from datetime import datetime, timedelta, timezone, time
+from datetime import date, datetime, timedelta, timezone, time
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from psycopg2.pool import SimpleConnectionPool
-from typing import List, Dict, Any
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 
 # =========================
 # TZ helpers (стабильно для pandas)
@@ -49,6 +55,35 @@ BIRTHDAYS_CHAT_IDS = [int(x) for x in os.getenv("BIRTHDAYS_CHAT_IDS", "").split(
 if not BIRTHDAYS_CHAT_IDS:
     BIRTHDAYS_CHAT_IDS = CHAT_IDS
 
+# Отдельное сообщение со списком потенциальных клиентов с ДР
+POTENTIAL_CLIENTS_CHAT_IDS = [int(x) for x in os.getenv("POTENTIAL_CLIENTS_CHAT_IDS", "6775209607").split(",") if x.strip()]
+
+# === Календарь ДР: индекс по дню года, переиспользуется между запусками до истечения TTL
+BIRTHDAY_INDEX_PATH     = os.getenv("BIRTHDAY_INDEX_PATH", "birthday_index.json")
+BIRTHDAY_INDEX_TTL_DAYS = int(os.getenv("BIRTHDAY_INDEX_TTL_DAYS", "7"))
+BIRTHDAY_DIGEST_WEEKDAY = int(os.getenv("BIRTHDAY_DIGEST_WEEKDAY", "0"))  # 0 = понедельник, -1 = выкл.
+BIRTHDAY_DIGEST_DAYS    = int(os.getenv("BIRTHDAY_DIGEST_DAYS", "7"))
+
+# === Телефонный индекс контактов/сделок Bitrix (для пометок «наш клиент» у звонивших)
+PHONE_INDEX_PATH               = os.getenv("PHONE_INDEX_PATH", "phone_index.json")
+PHONE_INDEX_FULL_REFRESH_DAYS  = int(os.getenv("PHONE_INDEX_FULL_REFRESH_DAYS", "7"))
+
+# === Parquet-архив записей по дням; REPORT_SOURCE=archive — строить отчёт из архива вместо БД
+ARCHIVE_DIR   = os.getenv("ARCHIVE_DIR", "support_archive")
+REPORT_SOURCE = os.getenv("REPORT_SOURCE", "db").strip().lower()   # db | archive
+
+# === Журнал запусков: готовые отчёты и статусы доставки по дням (для дешёвых повторов)
+RUN_JOURNAL_DIR = os.getenv("RUN_JOURNAL_DIR", "run_journal")
+
+# === Несколько команд из одного запуска: см. load_report_profiles (REPORT_PROFILES)
+
+# === Дашборд: формат, размер и режим рендера
+DASHBOARD_FORMAT  = os.getenv("DASHBOARD_FORMAT", "png").strip().lower()    # png | jpeg | webp
+DASHBOARD_DPI     = int(os.getenv("DASHBOARD_DPI", "120"))                   # Telegram всё равно ужимает фото до 1280px
+DASHBOARD_SIZE    = tuple(float(x) for x in os.getenv("DASHBOARD_SIZE", "16x9").lower().split("x"))  # дюймы, "ШxВ"
+DASHBOARD_QUALITY = int(os.getenv("DASHBOARD_QUALITY", "85"))                # для jpeg/webp
+DASHBOARD_RENDER_PROCESS = os.getenv("DASHBOARD_RENDER_PROCESS", "1") != "0" # рендер в отдельном процессе
+
 # =========================
 # POSTGRESQL CONNECTION POOL
 # =========================
@@ -95,35 +130,169 @@ def now_kyiv():
         return datetime.now(timezone.utc).astimezone(KYIV_TZ)
 
 _now = now_kyiv()
-report_day = (_now - timedelta(days=1)).date()                           # вчора
+# REPORT_DAY=YYYY-MM-DD — перерахунок за довільний день (напр. з архіву)
+report_day = (
+    datetime.strptime(os.environ["REPORT_DAY"], "%Y-%m-%d").date() if os.getenv("REPORT_DAY")
+    else (_now - timedelta(days=1)).date()                               # вчора
+)
 start_date = datetime.combine(report_day, time(0, 0), tzinfo=KYIV_TZ)    # 00:00 Київ
 end_date_exclusive = start_date + timedelta(days=1)                      # напіввідкритий інтервал
 
+# Штатний запуск — звіт за вчора; інший день — перерахунок історії (без ДР і без оновлення індексів Bitrix)
+IS_LIVE_DAY = report_day == (_now - timedelta(days=1)).date()
+
+# REPORT_DELIVER=0/1 — слати в Telegram. По умолчанию перерахунки (REPORT_DAY или REPORT_SOURCE=archive)
+# ничего не шлют: тексты и картинки остаются в журнале
+_report_deliver_env = (os.getenv("REPORT_DELIVER") or "").strip()
+REPORT_DELIVER = (
+    _report_deliver_env != "0" if _report_deliver_env
+    else not (os.getenv("REPORT_DAY") or REPORT_SOURCE == "archive")
+)
+
 # =========================
 # Інфра
 # =========================
-def send_message(text, chat_ids):
+def telegram_ok(r) -> bool:
+    """Telegram отвечает {"ok": true, ...}; всё остальное считаем неудачей."""
+    try:
+        return r.ok and bool(r.json().get("ok"))
+    except Exception:
+        return False
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+HTML_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*>")
+
+def tg_len(text: str) -> int:
+    """Длина в UTF-16 единицах — так Telegram считает лимит (эмодзи = 2)."""
+    return len(text.encode("utf-16-le")) // 2
+
+def _split_long_line(line: str, limit: int) -> List[str]:
+    """Порезать одну слишком длинную строку по пробелам, не разрывая теги и &entity;."""
+    parts, rest = [], line
+    while tg_len(rest) > limit:
+        cut = limit
+        while tg_len(rest[:cut]) > limit:
+            cut -= max(1, (tg_len(rest[:cut]) - limit) // 2)
+        head = rest[:cut]
+        space = head.rfind(" ")
+        if space > len(head) // 2:
+            head = head[:space + 1]
+        # не резать внутри тега или HTML-сущности
+        for opener, closer in (("<", ">"), ("&", ";")):
+            i = head.rfind(opener)
+            if i > head.rfind(closer):
+                head = head[:i]
+        if not head:
+            head = rest[:cut]
+        parts.append(head)
+        rest = rest[len(head):]
+    parts.append(rest)
+    return parts
+
+def _track_tags(open_tags: List[tuple], line: str) -> List[tuple]:
+    """Стек открытых тегов [(имя, открывающий тег целиком)] после строки line."""
+    stack = list(open_tags)
+    for m in HTML_TAG_RE.finditer(line):
+        name = m.group(2).lower()
+        if not m.group(1):
+            stack.append((name, m.group(0)))
+        elif any(n == name for n, _ in stack):
+            while stack and stack.pop()[0] != name:
+                pass
+    return stack
+
+def _closing(open_tags: List[tuple]) -> str:
+    return "".join(f"</{name}>" for name, _ in reversed(open_tags))
+
+def split_html_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Разбить HTML-текст на части <= limit по границам строк.
+
+    Теги, открытые на границе части, закрываются в её конце и заново открываются
+    в начале следующей, так что каждая часть — валидный HTML для parse_mode=HTML.
+    """
+    if tg_len(text) <= limit:
+        return [text]
+
+    chunks: List[str] = []
+    current = ""
+    started = False
+    open_tags: List[tuple] = []
+
+    for raw_line in text.split("\n"):
+        reopen = "".join(tag for _, tag in open_tags)
+        budget = limit - tg_len(reopen) - tg_len(_closing(open_tags)) - 64  # запас на теги внутри строки
+        # куски одной длинной строки склеиваем без перевода строки
+        for i, piece in enumerate(_split_long_line(raw_line, max(1, budget))):
+            sep = "\n" if i == 0 else ""
+            after = _track_tags(open_tags, piece)
+            candidate = current + sep + piece if started else piece
+            started = True
+            if current and tg_len(candidate) + tg_len(_closing(after)) > limit:
+                chunks.append(current + _closing(open_tags))
+                current = "".join(tag for _, tag in open_tags) + piece
+            else:
+                current = candidate
+            open_tags = after
+    if current:
+        chunks.append(current + _closing(open_tags))
+    return [c for c in chunks if c.strip()]
+
+def send_message(text, chat_ids) -> Dict[int, bool]:
+    """Отправить текст в чаты частями (split_html_message) по порядку; статус по каждому чату.
+
+    Если часть не дошла, остальные части в этот чат не шлём, чтобы не нарушить порядок.
+    """
     url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
+    chunks = split_html_message(text)
+    results: Dict[int, bool] = {}
     for chat_id in chat_ids:
-        try:
-            requests.post(url, data={"chat_id": chat_id, "text": text, "parse_mode": "HTML"}, timeout=30)
-        except Exception as e:
-            print(f"send_message error for {chat_id}: {e}")
-
-def send_photo(image_path, chat_ids):
+        results[chat_id] = True
+        for chunk in chunks:
+            try:
+                r = requests.post(url, data={"chat_id": chat_id, "text": chunk, "parse_mode": "HTML"}, timeout=30)
+                ok = telegram_ok(r)
+                if not ok:
+                    print(f"send_message failed for {chat_id}: {r.text[:200]}")
+            except Exception as e:
+                print(f"send_message error for {chat_id}: {e}")
+                ok = False
+            if not ok:
+                results[chat_id] = False
+                break
+    return results
+
+def send_photo(image_path, chat_ids) -> Dict[int, bool]:
+    """Файл загружаем один раз, остальным чатам шлём file_id из ответа Telegram."""
     url = f"https://api.telegram.org/bot{TOKEN}/sendPhoto"
+    file_id = None
+    results: Dict[int, bool] = {}
     for chat_id in chat_ids:
         try:
-            with open(image_path, "rb") as photo:
-                requests.post(url, data={"chat_id": chat_id}, files={"photo": photo}, timeout=60)
+            if file_id:
+                r = requests.post(url, data={"chat_id": chat_id, "photo": file_id}, timeout=60)
+            else:
+                with open(image_path, "rb") as photo:
+                    r = requests.post(url, data={"chat_id": chat_id}, files={"photo": photo}, timeout=60)
+                if telegram_ok(r):
+                    photos = (r.json().get("result") or {}).get("photo") or []
+                    file_id = photos[-1].get("file_id") if photos else None
+            results[chat_id] = telegram_ok(r)
+            if not results[chat_id]:
+                print(f"send_photo failed for {chat_id}: {r.text[:200]}")
         except Exception as e:
             print(f"send_photo error for {chat_id}: {e}")
+            results[chat_id] = False
+    return results
 
 # =========================
 # Bitrix helpers для ДР
 # =========================
-def b24_paged_get(url: str, base_params: Dict[str, Any]) -> List[Dict[str, Any]]:
-    """Пагинация Bitrix24: ?start=N, собираем весь result/items."""
+def b24_paged_fetch(url: str, base_params: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], bool]:
+    """Пагинация Bitrix24: ?start=N, собираем весь result/items.
+
+    Возвращает (items, complete): complete=False, если запрос или API упали на какой-то
+    странице и items — только то, что успели получить.
+    """
     items: List[Dict[str, Any]] = []
     start = 0
     while True:
@@ -135,7 +304,7 @@ def b24_paged_get(url: str, base_params: Dict[str, Any]) -> List[Dict[str, Any]]
             data = r.json()
         except Exception as e:
             print(f"❌ Bitrix request failed ({url}): {e}")
-            break
+            return items, False
 
         chunk = data.get("result", [])
         if isinstance(chunk, dict) and "items" in chunk:
@@ -144,14 +313,18 @@ def b24_paged_get(url: str, base_params: Dict[str, Any]) -> List[Dict[str, Any]]
             # если вернулась ошибка API (например, INVALID_CREDENTIALS)
             if "error" in data:
                 print(f"❌ Bitrix error: {data.get('error')} {data.get('error_description')}")
-            break
+                return items, False
+            return items, True
 
         items.extend(chunk)
         next_start = data.get("next")
         if next_start is None:
-            break
+            return items, True
         start = next_start
-    return items
+
+def b24_paged_get(url: str, base_params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Как b24_paged_fetch, но без признака полноты (для справочников, где частичный ответ не страшен)."""
+    return b24_paged_fetch(url, base_params)[0]
 
 def clean_phone(p: str) -> str:
     return re.sub(r"\D", "", p or "")
@@ -181,80 +354,177 @@ def parse_b24_date(d: str):
     except Exception:
         return None
 
-def b24_get_employees_birthday_today() -> List[Dict[str, Any]]:
-    """Сотрудники с ДР сегодня (PERSONAL_BIRTHDAY), фильтруем ACTIVE на клиенте."""
-    if not BITRIX_USERS_URL:
+# =========================
+# Календарь ДР: один fetch -> индекс по дню года
+# =========================
+def birthday_doy(month: int, day: int) -> int:
+    """День года по високосному календарю (1..366), чтобы 29.02 имел свою ячейку."""
+    return date(2000, month, day).timetuple().tm_yday
+
+def birthday_doys_for(d: date) -> List[int]:
+    """Ячейки индекса для даты; в невисокосный год 29.02 поздравляем 28.02."""
+    keys = [birthday_doy(d.month, d.day)]
+    if d.month == 2 and d.day == 28 and not calendar.isleap(d.year):
+        keys.append(birthday_doy(2, 29))
+    return keys
+
+def b24_employee_entry(u: Dict[str, Any]) -> Dict[str, Any]:
+    full_name = f"{(u.get('NAME') or '').strip()} {(u.get('LAST_NAME') or '').strip()}".strip() or "Без імені"
+    return {"id": u.get("ID"), "name": full_name}
+
+def b24_client_entry(c: Dict[str, Any]) -> Dict[str, Any]:
+    # Полное ФИО: Фамилия Имя Отчество
+    name_parts = [
+        (c.get('LAST_NAME') or '').strip(),
+        (c.get('NAME') or '').strip(),
+        (c.get('SECOND_NAME') or '').strip()
+    ]
+    full_name = " ".join([p for p in name_parts if p]) or "Без імені"
+    phones = []
+    for ph in c.get("PHONE", []) or []:
+        val = normalize_phone(ph.get("VALUE", ""))
+        if val:
+            phones.append(val)
+    # уникальные телефоны
+    seen, uniq = set(), []
+    for p in phones:
+        k = clean_phone(p)
+        if k not in seen:
+            seen.add(k)
+            uniq.append(p)
+    return {
+        "id": c.get("ID"),
+        "name": full_name,
+        "phones": uniq,
+        "date_create": c.get("DATE_CREATE", ""),
+        "assigned_by_id": c.get("ASSIGNED_BY_ID", "")
+    }
+
+def build_birthday_index() -> Dict[str, Any]:
+    """Скачать сотрудников и контакты один раз и разложить по дню года.
+
+    {"built": "YYYY-MM-DD", "complete": bool, "days": {"<doy>": {"employees": [...], "clients": [...]}}}
+    complete=False — какая-то из выгрузок упала или оборвалась на середине пагинации.
+    """
+    complete = True
+    days: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+
+    def bucket(md, kind: str, entry: Dict[str, Any]):
+        try:
+            doy = birthday_doy(*md)
+        except ValueError:
+            return
+        days.setdefault(str(doy), {"employees": [], "clients": []})[kind].append(entry)
+
+    if BITRIX_USERS_URL:
+        users, users_ok = b24_paged_fetch(
+            BITRIX_USERS_URL,
+            {"SELECT[]": ["ID", "NAME", "LAST_NAME", "PERSONAL_BIRTHDAY", "ACTIVE"]}
+        )
+        complete = complete and users_ok
+        for u in users or []:
+            # ACTIVE фильтруем на клиенте
+            if str(u.get("ACTIVE")).upper() not in ("Y", "TRUE", "1"):
+                continue
+            md = parse_b24_date(u.get("PERSONAL_BIRTHDAY"))
+            if md:
+                bucket(md, "employees", b24_employee_entry(u))
+    else:
         print("⚠ BITRIX_USERS_URL not set; skip employees birthdays")
-        return []
-    month_today, day_today = today_month_day()
-    items = b24_paged_get(
-        BITRIX_USERS_URL,
-        {"SELECT[]": ["ID", "NAME", "LAST_NAME", "PERSONAL_BIRTHDAY", "ACTIVE"]}
-    )
-    result = []
-    for u in items or []:
-        is_active = str(u.get("ACTIVE")).upper() in ("Y", "TRUE", "1")
-        if not is_active:
-            continue
-        md = parse_b24_date(u.get("PERSONAL_BIRTHDAY"))
-        if md and md == (month_today, day_today):
-            full_name = f"{(u.get('NAME') or '').strip()} {(u.get('LAST_NAME') or '').strip()}".strip() or "Без імені"
-            result.append({"id": u.get("ID"), "name": full_name})
-    result.sort(key=lambda x: x["name"].lower())
-    return result
 
-def b24_get_clients_birthday_today() -> List[Dict[str, Any]]:
-    """Клиенты с ДР сегодня (BIRTHDATE) + нормализованные телефоны."""
-    if not BITRIX_CONTACT_URL:
+    if BITRIX_CONTACT_URL:
+        contacts, contacts_ok = b24_paged_fetch(
+            BITRIX_CONTACT_URL,
+            {"filter[!BIRTHDATE]": "", "select[]": ["ID", "NAME", "SECOND_NAME", "LAST_NAME", "BIRTHDATE", "PHONE", "DATE_CREATE", "ASSIGNED_BY_ID"]}
+        )
+        complete = complete and contacts_ok
+        for c in contacts or []:
+            md = parse_b24_date(c.get("BIRTHDATE"))
+            if md:
+                bucket(md, "clients", b24_client_entry(c))
+    else:
         print("⚠ BITRIX_CONTACT_URL not set; skip clients birthdays")
-        return []
-    month_today, day_today = today_month_day()
-    items = b24_paged_get(
-        BITRIX_CONTACT_URL,
-        {"filter[!BIRTHDATE]": "", "select[]": ["ID", "NAME", "SECOND_NAME", "LAST_NAME", "BIRTHDATE", "PHONE", "DATE_CREATE", "ASSIGNED_BY_ID"]}
-    )
+
+    for b in days.values():
+        b["employees"].sort(key=lambda x: x["name"].lower())
+        b["clients"].sort(key=lambda x: x["name"].lower())
+    return {"built": now_kyiv().date().isoformat(), "complete": complete, "days": days}
+
+_birthday_index: Optional[Dict[str, Any]] = None
+
+def get_birthday_index() -> Dict[str, Any]:
+    """Индекс ДР из BIRTHDAY_INDEX_PATH, пока ему меньше BIRTHDAY_INDEX_TTL_DAYS; иначе новый fetch.
+
+    Неполный индекс (сбой Bitrix) используется только в этом запуске и на диск не пишется.
+    """
+    global _birthday_index
+    if _birthday_index is not None:
+        return _birthday_index
+
+    today = now_kyiv().date()
+    try:
+        with open(BIRTHDAY_INDEX_PATH, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        built = datetime.strptime(index["built"], "%Y-%m-%d").date()
+        if index.get("complete") and 0 <= (today - built).days < BIRTHDAY_INDEX_TTL_DAYS:
+            _birthday_index = index
+            return index
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠ Birthday index unreadable, rebuilding: {e}")
+
+    index = build_birthday_index()
+    if not index["complete"]:
+        # частичный индекс не сохраняем, чтобы не терять ДР до конца TTL
+        print("⚠ Birthday index incomplete (Bitrix error); not saving it")
+    else:
+        tmp = BIRTHDAY_INDEX_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp, BIRTHDAY_INDEX_PATH)
+    _birthday_index = index
+    return index
+
+def birthdays_on(d: date) -> Dict[str, List[Dict[str, Any]]]:
+    """Сотрудники и клиенты с ДР в дату d."""
+    days = get_birthday_index()["days"]
+    result: Dict[str, List[Dict[str, Any]]] = {"employees": [], "clients": []}
+    for doy in birthday_doys_for(d):
+        b = days.get(str(doy)) or {}
+        result["employees"].extend(b.get("employees", []))
+        result["clients"].extend(b.get("clients", []))
+    return result
+
+def birthdays_next_days(start: date, n_days: int) -> List[tuple]:
+    """[(date, {"employees": [...], "clients": [...]}), ...] для дат start..start+n_days-1 с ДР."""
     result = []
-    for c in items or []:
-        md = parse_b24_date(c.get("BIRTHDATE"))
-        if not md or md != (month_today, day_today):
-            continue
-        # Полное ФИО: Фамилия Имя Отчество
-        name_parts = [
-            (c.get('LAST_NAME') or '').strip(),
-            (c.get('NAME') or '').strip(),
-            (c.get('SECOND_NAME') or '').strip()
-        ]
-        full_name = " ".join([p for p in name_parts if p]) or "Без імені"
-        phones = []
-        for ph in c.get("PHONE", []) or []:
-            val = normalize_phone(ph.get("VALUE", ""))
-            if val:
-                phones.append(val)
-        # уникальные телефоны
-        seen, uniq = set(), []
-        for p in phones:
-            k = clean_phone(p)
-            if k not in seen:
-                seen.add(k)
-                uniq.append(p)
-        result.append({
-            "id": c.get("ID"),
-            "name": full_name,
-            "phones": uniq,
-            "date_create": c.get("DATE_CREATE", ""),
-            "assigned_by_id": c.get("ASSIGNED_BY_ID", "")
-        })
-    result.sort(key=lambda x: x["name"].lower())
+    for i in range(n_days):
+        d = start + timedelta(days=i)
+        b = birthdays_on(d)
+        if b["employees"] or b["clients"]:
+            result.append((d, b))
     return result
 
-def b24_get_deals_for_contacts(contact_ids: List[str]) -> Dict[str, List[Dict[str, Any]]]:
-    """Получить все сделки для списка контактов, сгруппированные по CONTACT_ID."""
+def b24_get_employees_birthday_today() -> List[Dict[str, Any]]:
+    """Сотрудники с ДР сегодня (PERSONAL_BIRTHDAY, только ACTIVE) — из индекса."""
+    return birthdays_on(now_kyiv().date())["employees"]
+
+def b24_get_clients_birthday_today() -> List[Dict[str, Any]]:
+    """Клиенты с ДР сегодня (BIRTHDATE) + нормализованные телефоны — из индекса."""
+    return birthdays_on(now_kyiv().date())["clients"]
+
+def b24_get_deals_for_contacts(contact_ids: List[str]) -> Tuple[Dict[str, List[Dict[str, Any]]], bool]:
+    """Получить все сделки для списка контактов, сгруппированные по CONTACT_ID.
+
+    Возвращает (сделки, complete); complete=False — выгрузка сделок оборвалась.
+    """
     if not BITRIX_DEALS_URL or not contact_ids:
-        return {}
+        return {}, True
 
     # Битрикс не поддерживает фильтр по нескольким CONTACT_ID напрямую,
     # поэтому получаем все сделки и фильтруем на клиенте
-    deals = b24_paged_get(
+    deals, complete = b24_paged_fetch(
         BITRIX_DEALS_URL,
         {"select[]": ["ID", "TITLE", "CATEGORY_ID", "STAGE_ID", "STAGE_SEMANTIC_ID",
                       "DATE_CREATE", "DATE_MODIFY", "ASSIGNED_BY_ID", "CONTACT_ID"]}
@@ -278,7 +548,7 @@ def b24_get_deals_for_contacts(contact_ids: List[str]) -> Dict[str, List[Dict[st
                     contact_deals[cid] = []
                 contact_deals[cid].append(deal)
 
-    return contact_deals
+    return contact_deals, complete
 
 def parse_b24_datetime(dt_str: str):
     """Парсинг даты Bitrix24 формата 'YYYY-MM-DDTHH:MM:SS+03:00'."""
@@ -346,8 +616,18 @@ def get_user_name_by_id(user_id: str, users_cache: Dict[str, str]) -> str:
     """Получить имя пользователя по ID из кеша."""
     return users_cache.get(str(user_id), f"ID:{user_id}")
 
+def user_names(user_ids: pd.Series, users_cache: Dict[str, str]) -> pd.Series:
+    """get_user_name_by_id для целой колонки ID, уже экранированные для parse_mode=HTML."""
+    ids = user_ids.astype(str)
+    return ids.map(users_cache).fillna("ID:" + ids).map(html.escape)
+
+_users_cache: Optional[Dict[str, str]] = None
+
 def build_users_cache() -> Dict[str, str]:
-    """Построить кеш ID пользователя -> Имя."""
+    """Построить кеш ID пользователя -> Имя (один fetch на запуск)."""
+    global _users_cache
+    if _users_cache is not None:
+        return _users_cache
     if not BITRIX_USERS_URL:
         return {}
 
@@ -363,6 +643,7 @@ def build_users_cache() -> Dict[str, str]:
         if uid and name:
             cache[uid] = name
 
+    _users_cache = cache
     return cache
 
 def build_stages_cache() -> Dict[str, str]:
@@ -399,20 +680,180 @@ def build_stages_cache() -> Dict[str, str]:
         print(f"⚠ Failed to load stages cache: {e}")
         return {}
 
+# =========================
+# Телефонний індекс: абонент підтримки -> контакт -> угоди
+# =========================
+DEAL_INDEX_FIELDS = ["ID", "CATEGORY_ID", "STAGE_ID", "DATE_MODIFY", "ASSIGNED_BY_ID", "CONTACT_ID"]
+
+def phone_key(phone) -> Optional[int]:
+    """Нормализованный номер как int (380XXXXXXXXX) — ключ индекса."""
+    digits = clean_phone(normalize_phone(str(phone) if phone is not None else ""))
+    return int(digits) if digits else None
+
+def deal_contact_ids(deal: Dict[str, Any]) -> List[str]:
+    # В Битрикс24 CONTACT_ID может быть массивом или одним значением
+    contact_id = deal.get("CONTACT_ID")
+    if isinstance(contact_id, list):
+        return [str(c) for c in contact_id if c]
+    return [str(contact_id)] if contact_id else []
+
+def _index_contacts(index: Dict[str, Any], contacts: List[Dict[str, Any]]):
+    """Добавить/обновить контакты: старые номера контакта снимаем, новые вешаем."""
+    phones, stored = index["phones"], index["contacts"]
+    for c in contacts:
+        cid = str(c.get("ID", ""))
+        if not cid:
+            continue
+        for key in (stored.get(cid) or {}).get("phones", []):
+            owners = phones.get(key, [])
+            if cid in owners:
+                owners.remove(cid)
+            if not owners:
+                phones.pop(key, None)
+        keys = sorted({k for k in (phone_key(ph.get("VALUE", "")) for ph in c.get("PHONE", []) or []) if k})
+        stored[cid] = {"phones": keys, "assigned_by_id": str(c.get("ASSIGNED_BY_ID") or "")}
+        for key in keys:
+            owners = phones.setdefault(key, [])
+            if cid not in owners:
+                owners.append(cid)
+
+def _index_deals(index: Dict[str, Any], deals: List[Dict[str, Any]]):
+    """Добавить/обновить сделки по ID и пересобрать CONTACT_ID -> [ID сделок]."""
+    stored = index["deals"]
+    for d in deals:
+        did = str(d.get("ID", ""))
+        if did:
+            stored[did] = {f: d.get(f) for f in DEAL_INDEX_FIELDS}
+    by_contact: Dict[str, List[str]] = {}
+    for did, d in stored.items():
+        for cid in deal_contact_ids(d):
+            by_contact.setdefault(cid, []).append(did)
+    index["contact_deals"] = by_contact
+
+def load_phone_index(refresh: bool = True) -> Optional[Dict[str, Any]]:
+    """Индекс телефонов из PHONE_INDEX_PATH, дозагруженный изменениями из Bitrix (DATE_MODIFY > synced).
+
+    Раз в PHONE_INDEX_FULL_REFRESH_DAYS — полная пересборка (чтобы ушли удалённые контакты/сделки).
+    synced сдвигается и файл пишется, только если обе выгрузки (контакты и сделки) дошли до конца.
+    refresh=False — только то, что уже лежит на диске, без запросов в Bitrix.
+    """
+    if not BITRIX_CONTACT_URL or not BITRIX_DEALS_URL:
+        print("⚠ BITRIX_CONTACT_URL/BITRIX_DEALS_URL not set; skip phone index")
+        return None
+
+    now = now_kyiv()
+    index = None
+    try:
+        with open(PHONE_INDEX_PATH, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        index["phones"] = {int(k): v for k, v in index["phones"].items()}
+        built = datetime.strptime(index["built"], "%Y-%m-%d").date()
+        if not 0 <= (now.date() - built).days < PHONE_INDEX_FULL_REFRESH_DAYS:
+            index = None
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠ Phone index unreadable, rebuilding: {e}")
+        index = None
+
+    if not refresh:
+        if index is not None:
+            _index_deals(index, [])
+        return index
+
+    contact_params = {"select[]": ["ID", "PHONE", "ASSIGNED_BY_ID"]}
+    deal_params = {"select[]": DEAL_INDEX_FIELDS}
+    if index is None:
+        index = {"built": now.date().isoformat(), "phones": {}, "contacts": {}, "deals": {}}
+    else:
+        contact_params["filter[>DATE_MODIFY]"] = index["synced"]
+        deal_params["filter[>DATE_MODIFY]"] = index["synced"]
+
+    contacts, contacts_ok = b24_paged_fetch(BITRIX_CONTACT_URL, contact_params)
+    deals, deals_ok = b24_paged_fetch(BITRIX_DEALS_URL, deal_params)
+    _index_contacts(index, contacts)
+    _index_deals(index, deals)
+    print(f"✅ Phone index: {len(index['phones'])} phones (+{len(contacts)} contacts, +{len(deals)} deals)")
+
+    if not (contacts_ok and deals_ok):
+        # synced не двигаем и файл не пишем: следующий запуск заново заберёт пропущенные изменения
+        print("⚠ Phone index refresh incomplete (Bitrix error); using it for this run only")
+        return index
+
+    index["synced"] = now.isoformat(timespec="seconds")
+    tmp = PHONE_INDEX_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({k: v for k, v in index.items() if k != "contact_deals"}, f, ensure_ascii=False)
+    os.replace(tmp, PHONE_INDEX_PATH)
+    return index
+
+def lookup_callers(index: Optional[Dict[str, Any]], phones) -> Dict[str, Dict[str, Any]]:
+    """Для каждого номера из записей: контакты, «наш клиент» и ответственные юристы.
+
+    {phone: {"contact_ids": [...], "is_our_client": bool, "lawyer_ids": [...]}}; номера без контакта пропускаются.
+    """
+    if not index:
+        return {}
+    result = {}
+    for phone in phones:
+        contact_ids = index["phones"].get(phone_key(phone)) or []
+        if not contact_ids:
+            continue
+        deals = [
+            index["deals"][did]
+            for cid in contact_ids
+            for did in index["contact_deals"].get(cid, [])
+        ]
+        category = categorize_client_by_deals(deals)
+        lawyer_ids = list(dict.fromkeys(str(d["assigned_by_id"]) for d in category["deals_info"] if d["assigned_by_id"]))
+        result[phone] = {
+            "contact_ids": contact_ids,
+            "is_our_client": category["is_our_client"],
+            "lawyer_ids": lawyer_ids,
+        }
+    return result
+
+def format_caller(info: Optional[Dict[str, Any]], users_cache: Dict[str, str]) -> str:
+    """Короткая пометка к номеру в отчёте."""
+    if not info:
+        return ""
+    if info["is_our_client"]:
+        lawyers = ", ".join(html.escape(get_user_name_by_id(uid, users_cache)) for uid in info["lawyer_ids"]) or "—"
+        return f" — ✅ наш клієнт, юрист: {lawyers}"
+    return f" — контакт #{info['contact_ids'][0]}"
+
+def format_birthday_digest() -> str:
+    """Дайджест ДР на ближайшие BIRTHDAY_DIGEST_DAYS дней (с завтрашнего), только в BIRTHDAY_DIGEST_WEEKDAY."""
+    today = now_kyiv().date()
+    if BIRTHDAY_DIGEST_DAYS <= 0 or today.weekday() != BIRTHDAY_DIGEST_WEEKDAY:
+        return ""
+    upcoming = birthdays_next_days(today + timedelta(days=1), BIRTHDAY_DIGEST_DAYS)
+    if not upcoming:
+        return ""
+    lines = [f"📆 <b>Найближчі дні народження</b> ({BIRTHDAY_DIGEST_DAYS} дн.):"]
+    for d, b in upcoming:
+        names = [f"👥 {html.escape(e['name'])}" for e in b["employees"]] + [html.escape(c["name"]) for c in b["clients"]]
+        lines.append(f"• <b>{d.strftime('%d.%m')}</b>: {', '.join(names)}")
+    return "\n".join(lines)
+
 def format_birthday_messages() -> Dict[str, str]:
     """Форматирование сообщений о днях рождения.
 
-    Возвращает словарь с двумя ключами:
+    Возвращает словарь с ключами:
     - "main": основное сообщение (сотрудники + все клиенты)
     - "potential_only": только потенциальные клиенты для отдельной отправки
+    - "complete": все выгрузки из Bitrix дошли до конца; иначе текст может быть неполным
     """
     employees = b24_get_employees_birthday_today()
     clients = b24_get_clients_birthday_today()
+    digest = format_birthday_digest()
+    complete = bool(get_birthday_index().get("complete"))
 
     if not employees and not clients:
         return {
-            "main": "📅 На сьогодні днів народження немає.",
-            "potential_only": ""
+            "main": "📅 На сьогодні днів народження немає." + (f"\n\n{digest}" if digest else ""),
+            "potential_only": "",
+            "complete": complete,
         }
 
     lines_main = ["🎂 Щоденна перевірка днів народження:"]
@@ -422,99 +863,193 @@ def format_birthday_messages() -> Dict[str, str]:
     if employees:
         lines_main.append("\n👥 Співробітники:")
         for e in employees:
-            lines_main.append(f"• {e['name']}")
+            lines_main.append(f"• {html.escape(e['name'])}")
 
     # Клиенты
-    potential_clients = []
     if clients:
-        # Получаем ID всех контактов с ДР
-        contact_ids = [c["id"] for c in clients]
-
-        # Получаем сделки для этих контактов
-        contact_deals = b24_get_deals_for_contacts(contact_ids)
-
-        # Кеш пользователей для отображения имен ответственных
+        # Сделки для всех контактов с ДР, кеши имён пользователей и названий стадий
+        contact_deals, deals_ok = b24_get_deals_for_contacts([c["id"] for c in clients])
+        complete = complete and deals_ok
         users_cache = build_users_cache()
-
-        # Кеш стадий для отображения названий стадий
         stages_cache = build_stages_cache()
 
-        # Разделяем клиентов на две категории
-        our_clients = []
-
-        for c in clients:
-            contact_id = str(c["id"])
-            deals = contact_deals.get(contact_id, [])
-            category = categorize_client_by_deals(deals)
+        cdf = pd.DataFrame(clients)
+        categories = [categorize_client_by_deals(contact_deals.get(str(cid), [])) for cid in cdf["id"]]
+        is_ours = pd.Series([cat["is_our_client"] for cat in categories], index=cdf.index)
 
-            client_info = {
-                "contact": c,
-                "category": category,
-                "contact_manager": get_user_name_by_id(c.get("assigned_by_id", ""), users_cache),
-                "date_create": c.get("date_create", "")
-            }
-
-            if category["is_our_client"]:
-                our_clients.append(client_info)
-            else:
-                potential_clients.append(client_info)
+        # Поля карточки клиента — колонками, без построчных append
+        cid = cdf["id"].astype(str)
+        name = "<b>" + cdf["name"].astype(str).map(html.escape) + "</b>"
+        phones = cdf["phones"].str.join(", ").where(cdf["phones"].str.len() > 0, "(тел. відсутній)")
+        link = "<a href='https://ua.zvilnymo.com.ua/crm/contact/details/" + cid + "/'>Контакт #" + cid + "</a>"
+        manager = user_names(cdf["assigned_by_id"], users_cache)
 
         # Форматируем НАШИХ клиентов (с расширенной информацией)
-        if our_clients:
+        if is_ours.any():
+            deals = pd.DataFrame(
+                [dict(d, client=i) for i, cat in zip(cdf.index, categories) for d in cat["deals_info"]],
+                columns=["client", "funnel_name", "stage_id", "days_in_stage", "assigned_by_id"],
+            )
+            stage = deals["stage_id"].map(stages_cache).fillna(deals["stage_id"])  # fallback на ID если не нашли
+            stage = stage.astype(str).map(html.escape)
+            deals["block"] = (
+                "\n   🗂️ Воронка: <b>" + deals["funnel_name"] + "</b>"
+                + "\n      • Стадія: " + stage
+                + "\n      • На стадії: " + deals["days_in_stage"].astype(str) + " днів"
+                + "\n      • Відповідальний юрист: " + user_names(deals["assigned_by_id"], users_cache)
+            )
+            deal_blocks = deals.groupby("client", sort=False)["block"].agg("".join).reindex(cdf.index, fill_value="")
+            ours = (
+                "\n📋 " + name + "\n   📞 " + phones + "\n   🆔 " + link
+                + "\n   👨‍💼 Менеджер: " + manager + deal_blocks
+            )[is_ours]
             lines_main.append("\n✅ <b>Наші клієнти</b> (є сделки в цільових воронках):")
-            for ci in our_clients:
-                c = ci["contact"]
-                phones_str = ", ".join(c["phones"]) if c["phones"] else "(тел. відсутній)"
-
-                lines_main.append(f"\n📋 <b>{c['name']}</b>")
-                lines_main.append(f"   📞 {phones_str}")
-                lines_main.append(f"   🆔 <a href='https://ua.zvilnymo.com.ua/crm/contact/details/{c['id']}/'>Контакт #{c['id']}</a>")
-                lines_main.append(f"   👨‍💼 Менеджер: {ci['contact_manager']}")
-
-                # Информация о сделках
-                for deal_info in ci["category"]["deals_info"]:
-                    lawyer = get_user_name_by_id(deal_info["assigned_by_id"], users_cache)
-
-                    # Получаем человекочитаемое название стадии
-                    stage_id = deal_info['stage_id']
-                    stage_name = stages_cache.get(stage_id, stage_id)  # fallback на ID если не нашли
-
-                    lines_main.append(f"   🗂️ Воронка: <b>{deal_info['funnel_name']}</b>")
-                    lines_main.append(f"      • Стадія: {stage_name}")
-                    lines_main.append(f"      • На стадії: {deal_info['days_in_stage']} днів")
-                    lines_main.append(f"      • Відповідальний юрист: {lawyer}")
+            lines_main.extend(ours.tolist())
 
         # Форматируем ПОТЕНЦИАЛЬНЫХ клиентов (для повторной продажи)
-        if potential_clients:
+        if not is_ours.all():
+            potential = ~is_ours
+            days_since_create = cdf["date_create"].map(days_since).astype(str)
+
             lines_main.append("\n🎯 <b>Потенційні клієнти</b> (немає угод в цільових воронках — можна спробувати продати!):")
+            lines_main.extend((
+                "• " + name + " — " + phones
+                + "\n  " + link + " | Створено: " + days_since_create + " днів тому | Менеджер: " + manager
+            )[potential].tolist())
 
             # Отдельное сообщение только для потенциальных клиентов
             lines_potential.append("🎯 <b>Потенційні клієнти з Днем народження!</b>")
             lines_potential.append("(немає угод в цільових воронках — можна спробувати продати!)\n")
+            lines_potential.extend((
+                "📋 " + name + "\n   📞 " + phones + "\n   🆔 " + link
+                + "\n   👨‍💼 Менеджер: " + manager
+                + "\n   📅 Створено: " + days_since_create + " днів тому\n"
+            )[potential].tolist())
 
-            for ci in potential_clients:
-                c = ci["contact"]
-                phones_str = ", ".join(c["phones"]) if c["phones"] else "(тел. відсутній)"
-
-                # Вычисляем сколько дней с создания контакта
-                days_since_create = days_since(ci["date_create"])
-
-                # Для основного сообщения
-                lines_main.append(f"• <b>{c['name']}</b> — {phones_str}")
-                lines_main.append(f"  <a href='https://ua.zvilnymo.com.ua/crm/contact/details/{c['id']}/'>Контакт #{c['id']}</a> | Створено: {days_since_create} днів тому | Менеджер: {ci['contact_manager']}")
-
-                # Для отдельного сообщения
-                lines_potential.append(f"📋 <b>{c['name']}</b>")
-                lines_potential.append(f"   📞 {phones_str}")
-                lines_potential.append(f"   🆔 <a href='https://ua.zvilnymo.com.ua/crm/contact/details/{c['id']}/'>Контакт #{c['id']}</a>")
-                lines_potential.append(f"   👨‍💼 Менеджер: {ci['contact_manager']}")
-                lines_potential.append(f"   📅 Створено: {days_since_create} днів тому\n")
+    if digest:
+        lines_main.append(f"\n{digest}")
 
     return {
         "main": "\n".join(lines_main),
-        "potential_only": "\n".join(lines_potential) if lines_potential else ""
+        "potential_only": "\n".join(lines_potential) if lines_potential else "",
+        "complete": complete,
     }
 
+# =========================
+# Дашборд: рендер
+# =========================
+DASHBOARD_EXT = {"png": "png", "jpeg": "jpg", "jpg": "jpg", "webp": "webp"}
+
+# Заготовки figure/axes по размеру — переиспользуются, если в процессе рендерится несколько дашбордов
+_dashboard_templates: Dict[tuple, tuple] = {}
+
+def dashboard_path(basename: str) -> str:
+    return f"{basename}.{DASHBOARD_EXT.get(DASHBOARD_FORMAT, 'png')}"
+
+def dashboard_save_kwargs() -> Dict[str, Any]:
+    """Параметры savefig под выбранный формат (оптимизированный PNG, JPEG, WebP)."""
+    fmt = DASHBOARD_FORMAT if DASHBOARD_FORMAT in DASHBOARD_EXT else "png"
+    if fmt == "png":
+        pil_kwargs = {"optimize": True}
+    elif fmt == "webp":
+        pil_kwargs = {"quality": DASHBOARD_QUALITY, "method": 6}
+    else:
+        fmt = "jpeg"
+        pil_kwargs = {"quality": DASHBOARD_QUALITY, "optimize": True, "progressive": True}
+    return {"format": fmt, "dpi": DASHBOARD_DPI, "bbox_inches": "tight", "pil_kwargs": pil_kwargs}
+
+def get_dashboard_template(figsize: tuple):
+    """Вернуть (fig, ax0, ax1, ax2): при первом вызове строим сетку, дальше только чистим оси."""
+    tpl = _dashboard_templates.get(figsize)
+    if tpl is None:
+        fig = plt.figure(figsize=figsize)
+        gs = fig.add_gridspec(2, 2, height_ratios=[1.4, 1.0], hspace=0.4, wspace=0.25)
+        tpl = (fig, fig.add_subplot(gs[0, :]), fig.add_subplot(gs[1, 0]), fig.add_subplot(gs[1, 1]))
+        _dashboard_templates[figsize] = tpl
+    else:
+        for ax in tpl[1:]:
+            ax.clear()
+    return tpl
+
+def render_dashboard(data: Dict[str, Any], image_path: str) -> str:
+    """Нарисовать дашборд по подготовленным данным и сохранить в image_path."""
+    t0 = _time.perf_counter()
+    hour_labels = data["hour_labels"]
+    events_values = data["events_values"]
+
+    fig, ax0, ax1, ax2 = get_dashboard_template(DASHBOARD_SIZE)
+    fig.suptitle(data["title"], fontsize=18, fontweight="bold")
+
+    ax0.plot(hour_labels, events_values, marker="o")
+    ax0.set_title("Звернення по годинах (усі події, час Києва)")
+    ax0.set_xlabel("Час")
+    ax0.set_ylabel("К-сть звернень")
+    ax0.set_xticks(range(0, len(hour_labels), max(1, len(hour_labels)//8)))
+    ax0.tick_params(axis='x', rotation=45)
+    ax0.set_ylim(bottom=0, top=max(1, int(max(events_values) * 1.2)))
+    for i in data["peak_idx"]:
+        ax0.annotate(f"пік: {events_values[i]}", (i, events_values[i]),
+                     textcoords="offset points", xytext=(0, 8), ha="center", fontsize=9)
+    for i in data["valley_idx"]:
+        ax0.annotate(f"мін: {events_values[i]}", (i, events_values[i]),
+                     textcoords="offset points", xytext=(0, -12), ha="center", fontsize=9)
+
+    x1 = np.arange(len(data["employees"]))
+    ax1.bar(x1, data["unique_clients"])
+    ax1.set_xticks(x1)
+    ax1.set_xticklabels(data["employees"], rotation=45, ha="right")
+    ax1.set_title("Унікальні клієнти по співробітнику")
+    ax1.set_ylabel("К-сть унікальних телефонів")
+    for i, v in enumerate(data["unique_clients"]):
+        ax1.text(i, v + 0.05, str(int(v)), ha='center', va='bottom')
+
+    x2 = np.arange(len(data["categories"]))
+    ax2.bar(x2, data["category_tasks"])
+    ax2.set_xticks(x2)
+    ax2.set_xticklabels(data["categories"], rotation=45, ha="right")
+    ax2.set_title("Розподіл задач за категоріями")
+    ax2.set_ylabel("К-сть задач")
+    for i, v in enumerate(data["category_tasks"]):
+        ax2.text(i, v + 0.05, str(int(v)), ha='center', va='bottom')
+
+    fig.tight_layout(rect=[0, 0.03, 1, 0.96])
+    fig.savefig(image_path, **dashboard_save_kwargs())
+
+    size_kb = os.path.getsize(image_path) / 1024
+    print(f"🖼 Дашборд {image_path}: {_time.perf_counter() - t0:.2f}s, {size_kb:.0f} KB")
+    return image_path
+
+def make_render_executor() -> Optional[ProcessPoolExecutor]:
+    """Отдельный процесс для matplotlib; None — рендерим в текущем процессе."""
+    if not DASHBOARD_RENDER_PROCESS:
+        return None
+    try:
+        return ProcessPoolExecutor(max_workers=1)
+    except Exception as e:
+        print(f"⚠ Render process unavailable, rendering inline: {e}")
+        return None
+
+def submit_dashboard(executor: Optional[ProcessPoolExecutor], data: Dict[str, Any], image_path: str) -> Future:
+    if executor is not None:
+        try:
+            return executor.submit(render_dashboard, data, image_path)
+        except Exception as e:
+            print(f"⚠ Failed to submit dashboard render: {e}")
+    future: Future = Future()
+    try:
+        future.set_result(render_dashboard(data, image_path))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def wait_dashboard(future: Future, data: Dict[str, Any], image_path: str) -> str:
+    """Дождаться рендера; если процесс упал — перерисовать в текущем процессе."""
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"⚠ Background render failed, retrying inline: {e}")
+        return render_dashboard(data, image_path)
+
 # =========================
 # Завантаження даних підтримки з PostgreSQL
 # =========================
@@ -548,35 +1083,179 @@ def load_support_data():
     finally:
         release_conn(conn)
 
+def load_support_watermark() -> Dict[str, Any]:
+    """Дешёвый «отпечаток» данных за вчера: кол-во записей, max(id), max(timestamp)."""
+    conn = get_conn()
+    try:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT count(*) AS records, max(r.id) AS max_id, max(r.timestamp) AS max_ts
+                FROM support_records r
+                WHERE r.timestamp >= %s AND r.timestamp < %s
+                """,
+                (start_date, end_date_exclusive)
+            )
+            return dict(cur.fetchone() or {})
+    finally:
+        release_conn(conn)
+
 # =========================
-# MAIN
+# Parquet-архів записів підтримки (історичні перерахунки без навантаження на PostgreSQL)
 # =========================
-def main():
-    # Инициализация пула соединений
-    init_pool()
+ARCHIVE_DICT_COLUMNS = ["employee", "category_code", "category"]
+ARCHIVE_DEFAULT_COLUMNS = ["id", "ts_utc", "employee_telegram_id", "employee", "category_code", "category", "phone"]
 
-    # Загружаем категории из БД
-    CATEGORIES = get_categories_dict()
-    NAME2CODE = {v: k for k, v in CATEGORIES.items()}
+def archive_partition_path(day: date) -> str:
+    return os.path.join(ARCHIVE_DIR, f"day={day.isoformat()}", "records.parquet")
 
-    # Загружаем данные из БД
-    records = load_support_data()
-
-    if not records:
-        print("⚠ Немає записів за вчора")
-        send_message(
-            f"📊 <b>Денний звіт підтримки</b> ({start_date.strftime('%d.%m.%Y')} — час Києва)\n\n"
-            f"❌ Немає записів за цей період",
-            CHAT_IDS
-        )
-        # Отправляем сообщение о днях рождения даже если нет записей
-        birthday_messages = format_birthday_messages()
-        send_message(birthday_messages["main"], BIRTHDAYS_CHAT_IDS)
-        if birthday_messages["potential_only"]:
-            send_message(birthday_messages["potential_only"], [6775209607])
+def archive_support_day(df: pd.DataFrame, day: date):
+    """Записать записи дня в партицию day=YYYY-MM-DD (перезапись — повторный запуск идемпотентен)."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("⚠ pyarrow not installed; skip Parquet archive")
         return
 
-    # Преобразуем в DataFrame
+    out = pd.DataFrame({
+        "id": df["id"].astype("int64"),
+        "ts_utc": df["dt_kyiv"].dt.tz_convert("UTC"),
+        "ts_kyiv": df["dt_kyiv"],
+        "employee_telegram_id": pd.to_numeric(df["employee_telegram_id"], errors="coerce").astype("Int64"),
+        "employee": df["employee"].astype(str),
+        "category_code": df["category_code"].astype(str),
+        "category": df["category"].astype(str),
+        "phone": df["phone"].map(lambda p: normalize_phone(str(p)) if pd.notna(p) else None),
+    })
+    for col in ARCHIVE_DICT_COLUMNS:
+        out[col] = out[col].astype("category")  # -> dictionary-encoded в Arrow/Parquet
+
+    path = archive_partition_path(day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(out, preserve_index=False)
+    pq.write_table(table, path + ".tmp", compression="zstd", use_dictionary=ARCHIVE_DICT_COLUMNS + ["phone"])
+    os.replace(path + ".tmp", path)
+    print(f"🗄 Archived {len(out)} records -> {path}")
+
+def load_archived_support_data(days: List[date], columns: Optional[List[str]] = None,
+                               categories: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+    """Прочитать нужные колонки нужных дней из архива (memory-mapped).
+
+    Возвращает кадр в формате load_support_data (timestamp в UTC без tz, employee_name,
+    category_name, ...), чтобы дальше шёл тот же prepare_support_df / compute_support_metrics.
+    categories — актуальный словарь КОД -> НАЗВАНИЕ, если названия категорий с тех пор исправили.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = columns or ARCHIVE_DEFAULT_COLUMNS
+    tables = [
+        pq.read_table(archive_partition_path(d), columns=columns, memory_map=True)
+        for d in days if os.path.exists(archive_partition_path(d))
+    ]
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    df = pa.concat_tables(tables, promote_options="permissive").to_pandas()
+
+    # dictionary -> обычные строки: groupby по Categorical добавил бы пустые категории
+    for col in ARCHIVE_DICT_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype(object)
+    if categories and "category_code" in df:
+        df["category"] = df["category_code"].map(categories).fillna(df.get("category", df["category_code"]))
+    if "ts_utc" in df:
+        df["timestamp"] = df.pop("ts_utc").dt.tz_convert("UTC").dt.tz_localize(None)
+    return df.rename(columns={"employee": "employee_name", "category": "category_name"})
+
+def archive_watermark(day: date) -> Dict[str, Any]:
+    """Отпечаток партиции для журнала запусков — по метаданным Parquet, без чтения данных."""
+    path = archive_partition_path(day)
+    if not os.path.exists(path):
+        return {"records": 0}
+    import pyarrow.parquet as pq
+    return {"records": pq.ParquetFile(path).metadata.num_rows, "max_id": None, "max_ts": os.path.getmtime(path)}
+
+# =========================
+# Профілі звітів (кілька команд з одного скану БД)
+# =========================
+def load_report_profiles() -> List[Dict[str, Any]]:
+    """Профили команд из REPORT_PROFILES (путь к JSON-файлу или сам JSON).
+
+    Формат — список объектов:
+    [{"key": "support", "name": "Підтримка",
+      "employees": [727013047, "Олена"],       # telegram_id или имя; пусто — все
+      "categories": ["CL1", "Чати"],            # код или название; пусто — все
+      "chat_ids": [727013047],
+      "birthdays": true,                        # слать блок ДР
+      "birthday_chat_ids": [727013047]}]        # по умолчанию — chat_ids
+
+    Без REPORT_PROFILES — один профиль на CHAT_IDS / BIRTHDAYS_CHAT_IDS, как раньше.
+    """
+    raw = (os.getenv("REPORT_PROFILES") or "").strip()
+    if not raw:
+        return [{
+            "key": "support", "name": "", "employees": [], "categories": [],
+            "chat_ids": CHAT_IDS, "birthdays": True, "birthday_chat_ids": BIRTHDAYS_CHAT_IDS,
+        }]
+
+    if not raw.lstrip().startswith("["):
+        with open(raw, "r", encoding="utf-8") as f:
+            raw = f.read()
+    items = json.loads(raw)
+
+    profiles = []
+    seen_keys = set()
+    for i, p in enumerate(items):
+        # key — имя в журнале и в файле дашборда, поэтому обязан быть уникальным
+        key = str(p.get("key") or f"team{i + 1}").strip()
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", key):
+            raise ValueError(f"REPORT_PROFILES[{i}]: invalid key {key!r} (allowed: A-Z, a-z, 0-9, _, -)")
+        if key in seen_keys:
+            raise ValueError(f"REPORT_PROFILES[{i}]: duplicate key {key!r}")
+        seen_keys.add(key)
+
+        chat_ids = [int(x) for x in p.get("chat_ids") or []]
+        if not chat_ids:
+            raise ValueError(f"REPORT_PROFILES[{i}] ({key}): chat_ids is empty")
+        profiles.append({
+            "key": key,
+            "name": str(p.get("name") or ""),
+            "employees": [str(x) for x in p.get("employees") or []],
+            "categories": [str(x) for x in p.get("categories") or []],
+            "chat_ids": chat_ids,
+            "birthdays": bool(p.get("birthdays", False)),
+            "birthday_chat_ids": [int(x) for x in p.get("birthday_chat_ids") or []] or chat_ids,
+        })
+    return profiles
+
+def unique_chat_ids(chat_lists) -> List[int]:
+    """Объединить списки чатов без повторов, сохраняя порядок."""
+    seen, result = set(), []
+    for chats in chat_lists:
+        for chat_id in chats:
+            if chat_id not in seen:
+                seen.add(chat_id)
+                result.append(chat_id)
+    return result
+
+def filter_profile_records(df: pd.DataFrame, profile: Dict[str, Any], name2code: Dict[str, str]) -> pd.DataFrame:
+    """Отобрать записи профиля по сотрудникам и категориям."""
+    mask = pd.Series(True, index=df.index)
+    if profile["employees"]:
+        wanted = set(profile["employees"])
+        mask &= df["employee_telegram_id"].astype(str).isin(wanted) | df["employee"].isin(wanted)
+    if profile["categories"]:
+        codes = {name2code.get(c, c) for c in profile["categories"]}
+        mask &= df["category_code"].isin(codes)
+    return df[mask]
+
+# =========================
+# Метрики та текст звіту
+# =========================
+THRESHOLD_REPEAT = 30  # поріг повторних звернень, %
+
+def prepare_support_df(records, categories: Dict[str, str]) -> pd.DataFrame:
     df = pd.DataFrame(records)
 
     # Преобразуем timestamp в Kyiv TZ
@@ -584,14 +1263,11 @@ def main():
 
     # Используем имена из БД или fallback
     df['employee'] = df['employee_name'].fillna('Невідомий')
-    df['category'] = df['category_name'].fillna(df['category_code'])
-
-    # Все записи уже за вчера (фильтр в SQL), все считаем выполненными
-    done_df = df.copy()
+    df['category'] = df['category_name'].fillna(df['category_code'].map(categories)).fillna(df['category_code'])
+    return df
 
-    # =========================
-    # Метрики (денні)
-    # =========================
+def compute_support_metrics(done_df: pd.DataFrame) -> Dict[str, Any]:
+    """Денні метрики по записах (всі записи за вчора вважаються виконаними)."""
     total_tasks = len(done_df)
 
     # Загальна частка повторних звернень (подій)
@@ -613,10 +1289,9 @@ def main():
         .sort_values(ascending=False).rename("tasks").reset_index()
     )
 
-    top_clients = (
-        done_df.groupby("phone")["id"].count()
-        .sort_values(ascending=False).head(3).rename("events").reset_index()
-    )
+    events_by_phone = done_df.groupby("phone")["id"].count().sort_values(ascending=False)
+    top_clients = events_by_phone.head(3).rename("events").reset_index()
+    repeat_callers = events_by_phone[events_by_phone >= 2].rename("events").reset_index()
 
     # Лічильники по кодам
     calls_small  = int((done_df["category_code"] == "CL1").sum())
@@ -633,11 +1308,7 @@ def main():
     sb_df = done_df[done_df["category_code"] == "SEC"]
     sb_unique_clients = int(sb_df["phone"].nunique(dropna=True))
 
-    # =========================
-    # === НОВЕ: повторні звернення по співробітниках
-    # =========================
-    THRESHOLD_REPEAT = 30  # поріг, %
-
+    # Повторні звернення по співробітниках
     emp_phone = (
         done_df.groupby(["employee", "phone"])["id"]
         .count()
@@ -667,9 +1338,7 @@ def main():
     )
     emp_summary = emp_summary.sort_values(["repeat_share_pct", "tasks_done"], ascending=[False, False]).reset_index(drop=True)
 
-    # =========================
-    # ЛІНІЙНИЙ ГРАФІК АКТИВНОСТІ (вчора, Київ)
-    # =========================
+    # Лінійний графік активності (вчора, Київ)
     hidx = pd.date_range(start=start_date, end=end_date_exclusive - timedelta(hours=1), freq="H", tz=KYIV_TZ)
     hour_floor = done_df["dt_kyiv"].dt.tz_convert(KYIV_TZ).dt.floor("H")
     events_by_hour = (
@@ -685,133 +1354,333 @@ def main():
         hour_labels = [d.strftime("%H:%M") for d in hidx]
         events_values = events_by_hour.values
 
-    peak_idx = np.argsort(-events_values)[:3]
-    valley_idx = np.argsort(events_values)[:1]
-
-    # =========================
-    # Дашборд
-    # =========================
-    from matplotlib.gridspec import GridSpec
-
-    fig = plt.figure(figsize=(16, 9))
-    gs = fig.add_gridspec(2, 2, height_ratios=[1.4, 1.0], hspace=0.4, wspace=0.25)
-    fig.suptitle(f"Підтримка • Денний звіт {start_date.strftime('%d.%m.%Y')} (час Києва)", fontsize=18, fontweight="bold")
+    return {
+        "total_tasks": total_tasks,
+        "repeat_rate": repeat_rate,
+        "tasks_by_employee": tasks_by_employee,
+        "cats": cats,
+        "top_clients": top_clients,
+        "repeat_callers": repeat_callers,
+        "calls_small": calls_small,
+        "calls_medium": calls_medium,
+        "calls_long": calls_long,
+        "total_calls": total_calls,
+        "total_hours": total_hours,
+        "total_chats": total_chats,
+        "total_conferences": total_conferences,
+        "sb_unique_clients": sb_unique_clients,
+        "emp_summary": emp_summary,
+        "hour_labels": hour_labels,
+        "events_values": events_values,
+    }
 
-    ax0 = fig.add_subplot(gs[0, :])
-    ax0.plot(hour_labels, events_values, marker="o")
-    ax0.set_title("Звернення по годинах (усі події, час Києва)")
-    ax0.set_xlabel("Час")
-    ax0.set_ylabel("К-сть звернень")
-    ax0.set_xticks(range(0, len(hour_labels), max(1, len(hour_labels)//8)))
-    ax0.tick_params(axis='x', rotation=45)
-    ax0.set_ylim(bottom=0, top=max(1, int(max(events_values) * 1.2)))
-    for i in peak_idx:
-        ax0.annotate(f"пік: {events_values[i]}", (i, events_values[i]),
-                     textcoords="offset points", xytext=(0, 8), ha="center", fontsize=9)
-    for i in valley_idx:
-        ax0.annotate(f"мін: {events_values[i]}", (i, events_values[i]),
-                     textcoords="offset points", xytext=(0, -12), ha="center", fontsize=9)
+def report_header(profile: Dict[str, Any]) -> str:
+    name = f" • {html.escape(profile['name'])}" if profile.get("name") else ""
+    return f"📊 <b>Денний звіт підтримки{name}</b> ({start_date.strftime('%d.%m.%Y')} — час Києва)"
 
-    ax1 = fig.add_subplot(gs[1, 0])
-    x1 = np.arange(len(emp_summary))
-    ax1.bar(x1, emp_summary["unique_clients"])
-    ax1.set_xticks(x1)
-    ax1.set_xticklabels(emp_summary["employee"], rotation=45, ha="right")
-    ax1.set_title("Унікальні клієнти по співробітнику")
-    ax1.set_ylabel("К-сть унікальних телефонів")
-    for i, v in enumerate(emp_summary["unique_clients"]):
-        ax1.text(i, v + 0.05, str(int(v)), ha='center', va='bottom')
+def build_dashboard_data(m: Dict[str, Any], profile: Dict[str, Any]) -> Dict[str, Any]:
+    """Сериализуемые данные для render_dashboard (уходят в процесс рендера)."""
+    events_values = m["events_values"]
+    emp_summary, cats = m["emp_summary"], m["cats"]
+    name = f" • {profile['name']}" if profile.get("name") else ""
+    return {
+        "title": f"Підтримка{name} • Денний звіт {start_date.strftime('%d.%m.%Y')} (час Києва)",
+        "hour_labels": list(m["hour_labels"]),
+        "events_values": [int(v) for v in events_values],
+        "peak_idx": [int(i) for i in np.argsort(-events_values)[:3]],
+        "valley_idx": [int(i) for i in np.argsort(events_values)[:1]],
+        "employees": emp_summary["employee"].tolist(),
+        "unique_clients": [int(v) for v in emp_summary["unique_clients"]],
+        "categories": cats["category"].tolist(),
+        "category_tasks": [int(v) for v in cats["tasks"]],
+    }
 
-    ax2 = fig.add_subplot(gs[1, 1])
-    x2 = np.arange(len(cats))
-    ax2.bar(x2, cats["tasks"])
-    ax2.set_xticks(x2)
-    ax2.set_xticklabels(cats["category"], rotation=45, ha="right")
-    ax2.set_title("Розподіл задач за категоріями")
-    ax2.set_ylabel("К-сть задач")
-    for i, v in enumerate(cats["tasks"]):
-        ax2.text(i, v + 0.05, str(int(v)), ha='center', va='bottom')
+def format_repeat_callers(repeat_callers: pd.DataFrame, callers: Dict[str, Dict[str, Any]], users_cache: Dict[str, str]) -> str:
+    """Блок «повторні клієнти в CRM»: сколько из повторных абонентов — наши клиенты, и кто именно."""
+    if not callers or repeat_callers.empty:
+        return ""
+    is_ours = repeat_callers["phone"].map(lambda p: bool((callers.get(p) or {}).get("is_our_client"))).astype(bool)
+    ours = repeat_callers[is_ours]
+    lines = (
+        "• <b>" + ours["phone"].astype(str).map(html.escape) + "</b>: " + ours["events"].astype(int).astype(str)
+        + ours["phone"].map(lambda p: format_caller(callers[p], users_cache))
+    )
+    header = f"📇 <b>Повторні звернення — наші клієнти</b>: <b>{len(ours)}</b> з {len(repeat_callers)}"
+    return "\n".join([header] + lines.tolist()) + "\n\n"
 
-    fig.tight_layout(rect=[0, 0.03, 1, 0.96])
-    dashboard_img = "support_daily_report.png"
-    fig.savefig(dashboard_img, dpi=200, bbox_inches="tight")
-    plt.close(fig)
+def build_kpi_text(m: Dict[str, Any], profile: Dict[str, Any],
+                   callers: Optional[Dict[str, Dict[str, Any]]] = None,
+                   users_cache: Optional[Dict[str, str]] = None) -> str:
+    callers, users_cache = callers or {}, users_cache or {}
+    tasks_by_employee = m["tasks_by_employee"]
+    emp_summary, cats, top_clients = m["emp_summary"], m["cats"], m["top_clients"]
 
-    # =========================
-    # Текст звіту підтримки
-    # =========================
     max_tasks = tasks_by_employee["tasks_done"].max() if len(tasks_by_employee) else 0
     min_tasks = tasks_by_employee["tasks_done"].min() if len(tasks_by_employee) else 0
 
-    def badge_tasks(tasks):
-        b = []
-        if tasks == max_tasks and tasks > 0:
-            b.append("🏆")
-        if tasks == min_tasks and tasks > 0 and max_tasks != min_tasks:
-            b.append("🔴")
-        return " ".join(b)
-
-    emp_lines = []
-    for _, r in emp_summary.iterrows():
-        emp = r["employee"]
-        t = int(r.get("tasks_done", 0))
-        u = int(r.get("unique_clients", 0))
-        emp_lines.append(f"• <b>{emp}</b> — задач: <b>{t}</b> {badge_tasks(t)} | унікальних клієнтів: <b>{u}</b>")
-    employees_inline_text = "\n".join(emp_lines)
-
-    rep_lines = []
-    for _, r in emp_summary.iterrows():
-        emp = r["employee"]
-        total_c = int(r.get("total_clients", 0))
-        repeat_c = int(r.get("repeat_clients", 0))
-        share = float(r.get("repeat_share_pct", 0.0))
-        flag = "🔴" if share > THRESHOLD_REPEAT else "🟢"
-        rep_lines.append(f"• <b>{emp}</b> — повторні клієнти: <b>{share}%</b> ({repeat_c} з {total_c}) {flag}")
-    repeat_inline_text = "\n".join(rep_lines)
-
-    cat_lines = [f"• <b>{row['category']}</b>: {int(row['tasks'])}" for _, row in cats.iterrows()]
-    cats_inline_text = "\n".join(cat_lines)
-
-    top_lines = [f"• <b>{row['phone']}</b>: {int(row['events'])}" for _, row in top_clients.iterrows()]
-    top_inline_text = "\n".join(top_lines)
-
-    kpi_text = (
-        f"📊 <b>Денний звіт підтримки</b> ({start_date.strftime('%d.%m.%Y')} — час Києва)\n\n"
-        f"✅ Всього виконано задач: <b>{total_tasks}</b>\n"
-        f"🔁 Частка повторних звернень (за день, по подіях): <b>{repeat_rate}%</b>\n\n"
-        f"☎️ <b>Дзвінки</b>: всього <b>{total_calls}</b> "
-        f"(короткі: <b>{calls_small}</b>, середні: <b>{calls_medium}</b>, довготривалі: <b>{calls_long}</b>)\n"
-        f"⏱️ <b>Годин у розмові</b> (оцінка): <b>{total_hours} год</b>\n"
-        f"💬 <b>Чати</b>: <b>{total_chats}</b>\n"
-        f"🎥 <b>Проведені конференції</b>: <b>{total_conferences}</b>\n"
-        f"🧩 <b>СБ (супровід)</b> — унікальних клієнтів: <b>{sb_unique_clients}</b>\n\n"
+    # Строки блоков собираем операциями над колонками
+    # имена, категории и телефоны из БД экранируем до вставки в HTML-разметку
+    emp = "<b>" + emp_summary["employee"].astype(str).map(html.escape) + "</b>"
+    t = emp_summary["tasks_done"].astype(int)
+    u = emp_summary["unique_clients"].astype(int)
+    badge = np.where(
+        (t == max_tasks) & (t > 0), "🏆",
+        np.where((t == min_tasks) & (t > 0) & (max_tasks != min_tasks), "🔴", "")
+    )
+    employees_inline_text = (
+        "• " + emp + " — задач: <b>" + t.astype(str) + "</b> " + badge
+        + " | унікальних клієнтів: <b>" + u.astype(str) + "</b>"
+    ).str.cat(sep="\n")
+
+    share = emp_summary["repeat_share_pct"].astype(float)
+    flag = np.where(share > THRESHOLD_REPEAT, "🔴", "🟢")
+    repeat_inline_text = (
+        "• " + emp + " — повторні клієнти: <b>" + share.astype(str) + "%</b> ("
+        + emp_summary["repeat_clients"].astype(int).astype(str) + " з "
+        + emp_summary["total_clients"].astype(int).astype(str) + ") " + flag
+    ).str.cat(sep="\n")
+
+    cats_inline_text = (
+        "• <b>" + cats["category"].astype(str).map(html.escape) + "</b>: " + cats["tasks"].astype(int).astype(str)
+    ).str.cat(sep="\n")
+
+    phone = top_clients["phone"].astype(str).map(html.escape)
+    top_inline_text = (
+        "• <b>" + phone + "</b>: " + top_clients["events"].astype(int).astype(str)
+        + top_clients["phone"].map(lambda p: format_caller(callers.get(p), users_cache))
+    ).str.cat(sep="\n")
+
+    return (
+        f"{report_header(profile)}\n\n"
+        f"✅ Всього виконано задач: <b>{m['total_tasks']}</b>\n"
+        f"🔁 Частка повторних звернень (за день, по подіях): <b>{m['repeat_rate']}%</b>\n\n"
+        f"☎️ <b>Дзвінки</b>: всього <b>{m['total_calls']}</b> "
+        f"(короткі: <b>{m['calls_small']}</b>, середні: <b>{m['calls_medium']}</b>, довготривалі: <b>{m['calls_long']}</b>)\n"
+        f"⏱️ <b>Годин у розмові</b> (оцінка): <b>{m['total_hours']} год</b>\n"
+        f"💬 <b>Чати</b>: <b>{m['total_chats']}</b>\n"
+        f"🎥 <b>Проведені конференції</b>: <b>{m['total_conferences']}</b>\n"
+        f"🧩 <b>СБ (супровід)</b> — унікальних клієнтів: <b>{m['sb_unique_clients']}</b>\n\n"
         f"👥 <b>По співробітниках</b>:\n{employees_inline_text}\n\n"
         f"🔁 <b>Повторні звернення по співробітниках</b> "
         f"(клієнти з ≥2 зверненнями; поріг: {THRESHOLD_REPEAT}%):\n{repeat_inline_text}\n\n"
         f"🏷️ <b>Категорії (розподіл задач)</b>:\n{cats_inline_text}\n\n"
         f"📱 <b>Топ-3 клієнтів за зверненнями</b>:\n{top_inline_text}\n\n"
+        f"{format_repeat_callers(m['repeat_callers'], callers, users_cache)}"
         f"📈 Лінійний графік звернень по годинах — див. на дашборді (час Києва)."
     )
 
+# =========================
+# Журнал запуску (повтори без перерахунку)
+# =========================
+def journal_dir() -> str:
+    # перерахунки без доставки пишут в отдельный каталог, чтобы не затереть статусы штатного запуска
+    suffix = "" if REPORT_DELIVER else "-rerun"
+    return os.path.join(RUN_JOURNAL_DIR, report_day.isoformat() + suffix)
+
+def journal_path() -> str:
+    return os.path.join(journal_dir(), "journal.json")
+
+def load_run_journal() -> Dict[str, Any]:
+    """Журнал за report_day: готовые тексты, дашборды, ДР и статусы доставки по чатам."""
+    try:
+        with open(journal_path(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"⚠ Run journal unreadable, starting fresh: {e}")
+        return {}
+
+def save_run_journal(journal: Dict[str, Any]):
+    """Атомарная запись: сначала во временный файл, потом os.replace."""
+    os.makedirs(journal_dir(), exist_ok=True)
+    tmp = journal_path() + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(journal, f, ensure_ascii=False, indent=1, default=str)
+    os.replace(tmp, journal_path())
+
+def build_watermark(records_wm: Dict[str, Any], categories: Dict[str, str], profiles: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Всё, от чего зависят тексты и дашборды: данные за день, категории, профили, формат картинки."""
+    def digest(obj) -> str:
+        return hashlib.sha1(json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+    return {
+        "records": int(records_wm.get("records") or 0),
+        "max_id": str(records_wm.get("max_id")),
+        "max_ts": str(records_wm.get("max_ts")),
+        "source": REPORT_SOURCE,
+        "categories": digest(categories),
+        "profiles": digest(profiles),
+        "dashboard": [DASHBOARD_FORMAT, DASHBOARD_DPI, list(DASHBOARD_SIZE), DASHBOARD_QUALITY],
+    }
+
+def journal_reports_valid(journal: Dict[str, Any], watermark: Dict[str, Any]) -> bool:
+    reports = journal.get("reports")
+    if not reports or journal.get("watermark") != watermark:
+        return False
+    # Картинку могли удалить руками — тогда пересчитываем
+    return all(not r.get("dashboard") or os.path.exists(r["dashboard"]) for r in reports.values())
+
+def deliver(journal: Dict[str, Any], item: str, send_fn, payload, chat_ids: List[int]):
+    """Отправить payload только в чаты, где item ещё не доставлен, и записать статусы в журнал."""
+    status = journal.setdefault("deliveries", {}).setdefault(item, {})
+    pending = [c for c in chat_ids if status.get(str(c)) != "ok"]
+    if not pending:
+        return
+    for chat_id, ok in send_fn(payload, pending).items():
+        status[str(chat_id)] = "ok" if ok else "failed"
+    save_run_journal(journal)
+
+def deliver_message(journal: Dict[str, Any], item: str, text: str, chat_ids: List[int]):
+    """Текст частями (split_html_message) — каждая часть отдельным пунктом журнала.
+
+    Чат, где часть не дошла, дальше не получает следующие части: повтор продолжит с неё же.
+    """
+    chunks = split_html_message(text)
+    pending = list(chat_ids)
+    for i, chunk in enumerate(chunks):
+        key = item if len(chunks) == 1 else f"{item}#{i + 1}"
+        deliver(journal, key, send_message, chunk, pending)
+        status = journal["deliveries"][key]
+        pending = [c for c in pending if status.get(str(c)) == "ok"]
+
+def journal_failures(journal: Dict[str, Any]) -> List[str]:
+    return [
+        f"{item}→{chat_id}"
+        for item, status in (journal.get("deliveries") or {}).items()
+        for chat_id, state in status.items() if state != "ok"
+    ]
+
+# =========================
+# MAIN
+# =========================
+def main():
+    # Инициализация пула соединений
+    init_pool()
+
+    profiles = load_report_profiles()
+
+    # Категории читаем один раз на все профили
+    CATEGORIES = get_categories_dict()
+    NAME2CODE = {v: k for k, v in CATEGORIES.items()}
+
+    # Журнал за день: если данные не менялись — берём готовые тексты и картинки
+    journal = load_run_journal()
+    from_archive = REPORT_SOURCE == "archive"
+    records_wm = archive_watermark(report_day) if from_archive else load_support_watermark()
+    watermark = build_watermark(records_wm, CATEGORIES, profiles)
+    reports_cached = journal_reports_valid(journal, watermark)
+
+    executor = None
+    pending_dashboards = {}
+    if reports_cached:
+        print(f"♻ Використовуємо збережені звіти з {journal_path()}")
+    else:
+        # Данные за день изменились (или первый запуск) — отчёты собираем и доставляем заново
+        journal = {
+            "report_day": report_day.isoformat(),
+            "watermark": watermark,
+            "reports": {},
+            "birthdays": journal.get("birthdays"),
+            "deliveries": {k: v for k, v in (journal.get("deliveries") or {}).items() if k.startswith("birthdays:")},
+        }
+
+        if from_archive:
+            records = load_archived_support_data([report_day], categories=CATEGORIES)
+        else:
+            records = load_support_data()
+        if not len(records):
+            print("⚠ Немає записів за вчора")
+        df = prepare_support_df(records, CATEGORIES) if len(records) else None
+        if df is not None and not from_archive:
+            try:
+                archive_support_day(df, report_day)
+            except Exception as e:
+                print(f"⚠ Failed to archive records: {e}")
+
+        # Считаем метрики по профилям и сразу отдаём дашборды в процесс рендера
+        executor = make_render_executor()
+        profile_metrics = {}
+        for profile in profiles:
+            profile_df = filter_profile_records(df, profile, NAME2CODE) if df is not None else None
+            if profile_df is None or profile_df.empty:
+                journal["reports"][profile["key"]] = {
+                    "kpi_text": f"{report_header(profile)}\n\n❌ Немає записів за цей період",
+                    "dashboard": None,
+                }
+                continue
+
+            m = compute_support_metrics(profile_df)
+            profile_metrics[profile["key"]] = m
+            dashboard_data = build_dashboard_data(m, profile)
+            basename = "support_daily_report" if len(profiles) == 1 else f"support_daily_report_{profile['key']}"
+            os.makedirs(journal_dir(), exist_ok=True)
+            dashboard_img = os.path.join(journal_dir(), dashboard_path(basename))
+            pending_dashboards[profile["key"]] = (submit_dashboard(executor, dashboard_data, dashboard_img), dashboard_data, dashboard_img)
+
+        # Звонившие -> контакты/сделки Bitrix (пока рисуются дашборды): один проход по индексу на все номера дня
+        callers: Dict[str, Dict[str, Any]] = {}
+        if profile_metrics:
+            callers = lookup_callers(load_phone_index(refresh=IS_LIVE_DAY), df["phone"].dropna().unique())
+        users_cache = build_users_cache() if callers else {}
+
+        for profile in profiles:
+            m = profile_metrics.get(profile["key"])
+            if m is not None:
+                journal["reports"][profile["key"]] = {"kpi_text": build_kpi_text(m, profile, callers, users_cache), "dashboard": None}
+
+    # Блок ДР — один раз на все профили; Bitrix-запросы идут параллельно с рендером
+    # ДР считаются по сегодняшней дате — для перерахунку прошлого дня и без доставки их не строим
+    birthday_chats = (
+        unique_chat_ids(p["birthday_chat_ids"] for p in profiles if p["birthdays"])
+        if IS_LIVE_DAY and REPORT_DELIVER else []
+    )
+    birthdays_failed = False
+    if birthday_chats and not journal.get("birthdays"):
+        fresh = format_birthday_messages()
+        if fresh["complete"]:
+            journal["birthdays"] = fresh
+        else:
+            # неполный блок не сохраняем и не шлём: перезапуск выгрузит Bitrix заново
+            print("⚠ Bitrix повернув неповні дані — блок днів народження не відправлено")
+            birthdays_failed = True
+    birthday_messages = journal.get("birthdays")
+
+    for key, pending in pending_dashboards.items():
+        journal["reports"][key]["dashboard"] = wait_dashboard(*pending)
+    if executor is not None:
+        executor.shutdown()
+    save_run_journal(journal)
+
+    if not REPORT_DELIVER:
+        print(f"📝 Доставку вимкнено (REPORT_DELIVER): звіти за {start_date.strftime('%d.%m.%Y')} збережено в {journal_dir()}")
+        return
+
     # =========================
-    # Відправка: 1) звіт підтримки
+    # Відправка: 1) звіти по профілях
     # =========================
-    send_photo(dashboard_img, CHAT_IDS)
-    send_message(kpi_text, CHAT_IDS)
+    for profile in profiles:
+        report = journal["reports"][profile["key"]]
+        if report["dashboard"]:
+            deliver(journal, f"{profile['key']}:photo", send_photo, report["dashboard"], profile["chat_ids"])
+        deliver_message(journal, f"{profile['key']}:kpi", report["kpi_text"], profile["chat_ids"])
 
     # =========================
     # Відправка: 2) окремий блок "Дні народження"
     # =========================
-    birthday_messages = format_birthday_messages()
-
-    # Основное сообщение (для всех чатов из BIRTHDAYS_CHAT_IDS)
-    send_message(birthday_messages["main"], BIRTHDAYS_CHAT_IDS)
+    if birthday_chats and birthday_messages:
+        # Основное сообщение (для всех чатов ДР из профилей)
+        deliver_message(journal, "birthdays:main", birthday_messages["main"], birthday_chats)
 
-    # Отдельное сообщение с потенциальными клиентами на специальный ID
-    if birthday_messages["potential_only"]:
-        send_message(birthday_messages["potential_only"], [6775209607])
+        # Отдельное сообщение с потенциальными клиентами на специальный ID
+        if birthday_messages["potential_only"]:
+            deliver_message(journal, "birthdays:potential", birthday_messages["potential_only"], POTENTIAL_CLIENTS_CHAT_IDS)
 
-    print(f"✅ Звіт за {start_date.strftime('%d.%m.%Y')} відправлено!")
+    failures = journal_failures(journal) + (["birthdays:bitrix"] if birthdays_failed else [])
+    if failures:
+        print(f"⚠ Не доставлено: {', '.join(failures)} — перезапуск відправить лише їх")
+    else:
+        print(f"✅ Звіт за {start_date.strftime('%d.%m.%Y')} відправлено!")
 
 if __name__ == "__main__":
     main()